@@ -4,8 +4,9 @@ import os
 import csv
 from collections import Counter
 import json
+from worker_server import serve
 
-def main(input_newick, predefined_label, csv_file):
+def main(input_newick, predefined_label, csv_file, output_dir="output"):
     # Check if the input files exist
     if not os.path.isfile(input_newick):
         return {"error": f"File '{input_newick}' does not exist."}
@@ -107,16 +108,29 @@ def main(input_newick, predefined_label, csv_file):
     }
 
     # Write the output to a file
-    with open("output/subtype_output.json", "w") as file:
+    with open(os.path.join(output_dir, "subtype_output.json"), "w") as file:
         json.dump(output, file)
 
     # Write patristic distances to a file
-    with open("output/patristic_distances.txt", "w") as file:
+    with open(os.path.join(output_dir, "patristic_distances.txt"), "w") as file:
         file.write(f"Patristic Distances from {predefined_label}:\n")
         for dist, label in distance_list:
             file.write(f"{label}: {dist}\n")
 
+    return output
+
+def warmup():
+    tree = dendropy.Tree.get(data="((A:0.1,B:0.2):0.1,C:0.3);", schema="newick")
+    tree.phylogenetic_distance_matrix()
+
+def handle_request(request):
+    return main(request["newick"], request["label"], request["csv"], request["output_dir"])
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--server"]:
+        serve(handle_request, warmup=warmup)
+        sys.exit(0)
+
     if len(sys.argv) != 4:
         print("Usage: python script.py <input_newick> <predefined_label> <csv_file>")
         sys.exit(1)
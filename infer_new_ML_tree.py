@@ -2,7 +2,10 @@ import subprocess
 import sys
 import json
 import os
-import streamlit as st
+import functools
+import itertools
+import collections
+from worker_server import serve
 
 def add_sequence_to_msa(existing_alignment, new_sequence, output_alignment):
     # Construct the MAFFT command as a string
@@ -33,81 +36,92 @@ def add_sequence_to_msa(existing_alignment, new_sequence, output_alignment):
 
     return None
 
+@functools.lru_cache(maxsize=8)
+def read_head(file_path, mtime, n=5):
+    # Keyed on mtime so the reference files are only re-read when they change
+    with open(file_path) as f:
+        return list(itertools.islice(f, n))
+
 def log_file_contents(file_path):
     if os.path.exists(file_path):
-        with open(file_path) as f:
-            st.write(f"Contents of {file_path}:\n", f.readlines()[:5])  # Log the first few lines
+        print(f"Contents of {file_path}:\n{''.join(read_head(file_path, os.stat(file_path).st_mtime))}", file=sys.stderr)  # Log the first few lines
     else:
-        st.error(f"File not found: {file_path}")
+        print(f"File not found: {file_path}", file=sys.stderr)
+
+
+def iqtree_env(threads):
+    # Keep OpenMP inside IQ-TREE to the same thread count as -T
+    return {**os.environ, "OMP_NUM_THREADS": str(threads)}
 
+def run_streamed(command, threads):
+    # Pass IQ-TREE's output through to stderr line by line as it is written,
+    # so the app can show it while the tree is running. Only the last few
+    # lines are kept for the error message.
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, shell=True, env=iqtree_env(threads))
+    tail = collections.deque(maxlen=5)
+    for line in proc.stdout:
+        sys.stderr.write(line)
+        tail.append(line)
+    return proc.wait(), "".join(tail).strip()
 
-def run_phylogenetic_placement(output_alignment, existing_tree):
+def run_phylogenetic_placement(output_alignment, existing_tree, threads):
     # Construct the IQ-TREE command as a string
-    iqtree_command = f"./iqtree2 -seed 2803 -redo -s {output_alignment} -g {existing_tree} -pre {output_alignment}_pp -m GTR+F+G4"
+    iqtree_command = f"./iqtree2 -seed 2803 -redo -T {threads} -s {output_alignment} -g {existing_tree} -pre {output_alignment}_pp -m GTR+F+G4"
     
-    st.write(f"Running command: {iqtree_command}")  # Log the command
+    print(f"Running command: {iqtree_command}", file=sys.stderr)  # Log the command
 
     try:
-        result = subprocess.run(iqtree_command, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-        st.write("IQ-TREE Standard Output:", result.stdout)
-        st.write("IQ-TREE Standard Error:", result.stderr)
-
-        if result.returncode != 0:
-            error_output = result.stderr.strip()
-            st.error(f"Failed to perform phylogenetic placement: {error_output}")
+        returncode, error_output = run_streamed(iqtree_command, threads)
+        if returncode != 0:
+            print(f"Failed to perform phylogenetic placement: {error_output}", file=sys.stderr)
             return {"error": f"Failed to perform phylogenetic placement: {error_output}"}
     except Exception as e:
-        st.error(f"Exception during IQ-TREE execution: {str(e)}")
+        print(f"Exception during IQ-TREE execution: {str(e)}", file=sys.stderr)
         return {"error": f"Exception during IQ-TREE execution: {str(e)}"}
 
     return None
 
-def infer_global_optimization_tree(output_alignment, output_tree):
+def infer_global_optimization_tree(output_alignment, output_tree, threads):
     # Construct the IQ-TREE command for optimization as a string
-    iqtree_command2 = f"./iqtree2 -seed 2803 -redo -s {output_alignment} -t {output_alignment}_pp.treefile -pre {output_tree} -m GTR+F+G4"
+    iqtree_command2 = f"./iqtree2 -seed 2803 -redo -T {threads} -s {output_alignment} -t {output_alignment}_pp.treefile -pre {output_tree} -m GTR+F+G4"
+
+    print(f"Running command: {iqtree_command2}", file=sys.stderr)  # Log the command
 
     try:
-        result = subprocess.run(iqtree_command2, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-        st.write(result.stdout)  # Log standard output
-        st.write(result.stderr)   # Log standard error
-        if result.returncode != 0:
-            error_output = result.stderr.strip()
+        returncode, error_output = run_streamed(iqtree_command2, threads)
+        if returncode != 0:
             print(f"iqtree_command2 Error: {error_output}", file=sys.stderr)
             return {"error": f"Failed to infer optimized tree: {error_output}"}
         return None
-    except subprocess.CalledProcessError as e:
+    except Exception as e:
         print(f"iqtree_command2 Error: {e}", file=sys.stderr)
         return {"error": f"Failed to infer optimized tree: {e}"}
 
-def main():
-    if len(sys.argv) != 6:
-        print("Usage: python script_name.py existing_alignment.fasta new_sequence.fasta existing_tree.treefile output_alignment.fasta output_tree_prefix", file=sys.stderr)
-        sys.exit(1)
-
-    existing_alignment = os.path.abspath(sys.argv[1])
-    new_sequence = os.path.abspath(sys.argv[2])
-    existing_tree = os.path.abspath(sys.argv[3])
-    output_alignment = os.path.abspath(sys.argv[4])
-    output_tree = os.path.abspath(sys.argv[5])
+def infer_tree(existing_alignment, new_sequence, existing_tree, output_alignment, output_tree, threads=1):
+    existing_alignment = os.path.abspath(existing_alignment)
+    new_sequence = os.path.abspath(new_sequence)
+    existing_tree = os.path.abspath(existing_tree)
+    output_alignment = os.path.abspath(output_alignment)
+    output_tree = os.path.abspath(output_tree)
 
     # Check file existence *before* doing anything else
     if not os.path.exists(existing_alignment):
-        print(f"ERROR: Existing alignment file not found: {existing_alignment}", file=sys.stderr)
-        sys.exit(1)
+        return {"error": f"Existing alignment file not found: {existing_alignment}"}
     if not os.path.exists(new_sequence):
-        print(f"ERROR: New sequence file not found: {new_sequence}", file=sys.stderr)
-        sys.exit(1)
+        return {"error": f"New sequence file not found: {new_sequence}"}
     if not os.path.exists(existing_tree):
-        print(f"ERROR: Existing tree file not found: {existing_tree}", file=sys.stderr)
-        sys.exit(1)
+        return {"error": f"Existing tree file not found: {existing_tree}"}
+
+    # Errors and the result are written next to the output alignment
+    error_json_path = os.path.join(os.path.dirname(output_alignment), "ml_tree_error.json")
 
     # Add new sequence to existing alignment
     error = add_sequence_to_msa(existing_alignment, new_sequence, output_alignment)
     if error:
-        with open("output/ml_tree_error.json", "w") as file:
+        with open(error_json_path, "w") as file:
             json.dump(error, file)
         print(f"Error during mafft: {error}", file=sys.stderr)
-        sys.exit(1)
+        return error
 
     # Call this function for the necessary files
     log_file_contents(existing_alignment)
@@ -115,20 +129,20 @@ def main():
     log_file_contents(existing_tree)
 
     # Run IQ-TREE phylogenetic placement first
-    error = run_phylogenetic_placement(output_alignment, existing_tree)
+    error = run_phylogenetic_placement(output_alignment, existing_tree, threads)
     if error:
-        with open("output/ml_tree_error.json", "w") as file:
+        with open(error_json_path, "w") as file:
             json.dump(error, file)
         print(f"Error during iqtree_command: {error}", file=sys.stderr)
-        sys.exit(1)
+        return error
 
     # Run IQ-TREE with the constraint tree for optimization
-    error = infer_global_optimization_tree(output_alignment, output_tree)
+    error = infer_global_optimization_tree(output_alignment, output_tree, threads)
     if error:
-        with open("output/ml_tree_error.json", "w") as file:
+        with open(error_json_path, "w") as file:
             json.dump(error, file)
         print(f"Error during iqtree_command2: {error}", file=sys.stderr)
-        sys.exit(1)
+        return error
 
     # Prepare output dictionary
     output = {
@@ -141,5 +155,25 @@ def main():
     with open(output_json_path, "w") as file:
         json.dump(output, file)
 
+    return output
+
+def handle_request(request):
+    return infer_tree(request["alignment"], request["input"], request["tree"], request["output_alignment"], request["output_tree"], request.get("threads", 1))
+
+def main():
+    if sys.argv[1:] == ["--server"]:
+        serve(handle_request)
+        return
+
+    if len(sys.argv) not in (6, 7):
+        print("Usage: python script_name.py existing_alignment.fasta new_sequence.fasta existing_tree.treefile output_alignment.fasta output_tree_prefix [threads]", file=sys.stderr)
+        sys.exit(1)
+
+    threads = int(sys.argv[6]) if len(sys.argv) == 7 else 1
+    result = infer_tree(*sys.argv[1:6], threads=threads)
+    if "error" in result:
+        print(f"ERROR: {result['error']}", file=sys.stderr)
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
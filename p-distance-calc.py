@@ -1,30 +1,25 @@
 import sys
+import os
 import json
+import functools
 from Bio import SeqIO, Align
+from worker_server import serve
 
-def calculate_p_distance(seq1, seq2):
-    # Create a PairwiseAligner object with appropriate scoring
-    aligner = Align.PairwiseAligner(scoring="blastn")
-    aligner.mode = "global"
+# Create a PairwiseAligner object with appropriate scoring, shared by every comparison
+aligner = Align.PairwiseAligner(scoring="blastn")
+aligner.mode = "global"
 
+def calculate_p_distance(seq1, seq2):
     # Perform the alignment 
     alignments = aligner.align(seq1, seq2)
 
     alignment = next(alignments)
 
-    # Extract aligned sequences as strings
-    aligned_seq1 = str(alignment[0])
-    aligned_seq2 = str(alignment[1])
-
-    # Count mismatches and valid positions (ignoring gaps)
-    mismatches = 0
-    total_positions = 0
-    
-    for a, b in zip(aligned_seq1, aligned_seq2):
-        if a != '-' or b != '-':  # Count all positions where at least one is valid
-            total_positions += 1
-            if a != b and a != '-' and b != '-':
-                mismatches += 1
+    # Count mismatches and valid positions (ignoring gaps) in C; a pairwise
+    # alignment has no all-gap columns, so every column has a valid position
+    counts = alignment.counts()
+    mismatches = counts.mismatches
+    total_positions = counts.gaps + counts.identities + counts.mismatches
     
     # Calculate p-distance
     if total_positions == 0:
@@ -32,53 +27,82 @@ def calculate_p_distance(seq1, seq2):
     p_distance = mismatches / total_positions
     return p_distance
 
-def main(input_fasta, reference_fasta):
-    try:
-        input_seq = next(SeqIO.parse(input_fasta, "fasta")).seq
-        input_id = next(SeqIO.parse(input_fasta, "fasta")).id  # Get the ID of the input sequence
-        min_distance = float('inf')
-        min_id = None
-        
-        # Read all reference sequences first to determine the total count
-        reference_records = list(SeqIO.parse(reference_fasta, "fasta"))
-        total_references = len(reference_records)
+@functools.lru_cache(maxsize=4)
+def load_references(reference_fasta, mtime):
+    # Parsed once per worker and re-read only when the file changes
+    return list(SeqIO.parse(reference_fasta, "fasta"))
+
+def run(input_fasta, reference_fasta, output_dir="output"):
+    # input_fasta may be a path or an open handle, so it is only parsed once
+    input_record = next(SeqIO.parse(input_fasta, "fasta"))
+    input_seq = input_record.seq
+    input_id = input_record.id  # Get the ID of the input sequence
+    min_distance = float('inf')
+    min_id = None
+    
+    # Read all reference sequences first to determine the total count
+    reference_records = load_references(reference_fasta, os.stat(reference_fasta).st_mtime)
+    total_references = len(reference_records)
+    
+    # Dictionary to store p-distances for each reference
+    p_distances = {}
+    
+    for index, record in enumerate(reference_records):
+        ref_seq = record.seq
+        distance = calculate_p_distance(str(input_seq), str(ref_seq))  
         
-        # Dictionary to store p-distances for each reference
-        p_distances = {}
+        # Store p-distance for this reference
+        p_distances[record.id] = distance
         
-        for index, record in enumerate(reference_records):
-            ref_seq = record.seq
-            distance = calculate_p_distance(str(input_seq), str(ref_seq))  
-            
-            # Store p-distance for this reference
-            p_distances[record.id] = distance
-            
-            # Check if this distance is the smallest found so far
-            if distance < min_distance:
-                min_distance = distance
-                min_id = record.id
+        # Check if this distance is the smallest found so far
+        if distance < min_distance:
+            min_distance = distance
+            min_id = record.id
 
-        # Prepare output dictionary
-        output = {
-            "closest_reference": min_id,
-            "p_distance": min_distance,
-            "below_cutoff": min_distance <= 0.1833
-        }
+    # Prepare output dictionary
+    output = {
+        "closest_reference": min_id,
+        "p_distance": min_distance,
+        "below_cutoff": min_distance <= 0.1833
+    }
 
-        # Write the output to a file
-        with open("output/p_distance_output.json", "w") as file:
-            json.dump(output, file)
-        
-        # Write p-distances to a file
-        with open("output/p_distances.txt", "w") as file:
-            for ref_id, distance in p_distances.items():
-                file.write(f"{ref_id}: {distance}\n")
+    # Write the output to a file
+    with open(os.path.join(output_dir, "p_distance_output.json"), "w") as file:
+        json.dump(output, file)
+    
+    # Write p-distances to a file
+    with open(os.path.join(output_dir, "p_distances.txt"), "w") as file:
+        for ref_id, distance in p_distances.items():
+            file.write(f"{ref_id}: {distance}\n")
 
+    return output
+
+def main(input_fasta, reference_fasta):
+    try:
+        # "-" reads the query FASTA from stdin and writes the result to stdout
+        if input_fasta == "-":
+            output = run(sys.stdin, reference_fasta)
+            json.dump(output, sys.stdout)
+        else:
+            run(input_fasta, reference_fasta)
     except Exception as e:
         sys.stderr.write(f"An error occurred: {e}\n")
         sys.exit(1)
 
+def warmup():
+    calculate_p_distance("ACGTACGTAC", "ACGTTCGTAC")
+    reference_fasta = os.path.abspath("reference_genomes.fa")
+    load_references(reference_fasta, os.stat(reference_fasta).st_mtime)
+
+def handle_request(request):
+    # The query FASTA is the upload's temp file, which is on tmpfs
+    return run(request["input"], request["reference"], request["output_dir"])
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--server"]:
+        serve(handle_request, warmup=warmup)
+        sys.exit(0)
+
     if len(sys.argv) != 3:
         print("Usage: python p_distance.py <input_fasta> <reference_fasta>")
         sys.exit(1)
@@ -3,246 +3,601 @@ import subprocess
 import sys
 import os
 import json
+import orjson
 import tempfile
-from Bio import SeqIO
+import shutil
+import stat
+import glob
+import hashlib
+import functools
 import time
-import zipfile
+import io
+import tarfile
+import zstandard as zstd
+import threading
+import signal
+import collections
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# The cached, timed steps of an analysis, in the order they finish
+STAGES = ("p_distance", "ml_tree", "subtype")
+
+DEFAULT_STAGE_TIMES = {"p_distance": 30.0, "ml_tree": 45.0, "subtype": 2.0}
+STAGE_TIME_SMOOTHING = 0.3
+
+# Label and progress bar range of each step of a running analysis
+STAGE_PROGRESS = {
+    "tree": ("Calculating p-distance and inferring new ML tree...", 0, 0.99),
+    "subtype": ("Inferring subtype...", 0.99, 1.0),
+}
+
+STAGE_MESSAGES = {
+    "p_distance": "P-distance calculation completed",
+    "ml_tree": "New ML tree inference completed",
+    "subtype": "Subtype inference completed",
+}
+
+CACHE_DIR = "cache"
+OUTPUT_DIR = "output"
+
+# Distinct inputs kept in CACHE_DIR, about 0.5 MB each; the least recently
+# used are dropped beyond this
+CACHE_MAX_ENTRIES = 200
+
+# Uploads and stage intermediates go to tmpfs when the host has one; output/
+# is then a symlink into it so the sidecar scripts and users find files under
+# the usual name. The cache stays on durable storage; the download archive is
+# built in memory.
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+SHM_OUTPUT_DIR = f"/dev/shm/rhev_out-{os.getuid()}" if SHM_DIR is not None else None
+
+REFERENCE_FASTA = "reference_genomes.fa"
+EXISTING_ALIGNMENT = "reference_alignment.fa"
+EXISTING_TREE = "reference_tree.tree"
+CSV_FILE = "reference_subtypes.csv"
+
+# Absolute paths of the reference inputs, resolved once rather than per request
+_REF_ABS = {name: os.path.abspath(name) for name in (REFERENCE_FASTA, EXISTING_ALIGNMENT, EXISTING_TREE, CSV_FILE)}
+
+# For the per-upload paths; avoids a getcwd() on every repeated lookup
+_abspath = functools.lru_cache(maxsize=128)(os.path.abspath)
+
+# Seconds a worker may spend on one request before it is killed and restarted;
+# a hung MAFFT or IQ-TREE would otherwise hold its worker, which every session
+# shares, for good
+WORKER_TIMEOUTS = {"p_distance": 600, "ml_tree": 3600, "subtype": 300}
+
+# IQ-TREE threads: physical cores only, as SMT siblings slow the likelihood kernels.
+# Counted from the CPUs this process may run on, since os.cpu_count() reports the
+# whole host inside a pinned container and IQ-TREE aborts when -T exceeds what it sees.
+if hasattr(os, "sched_getaffinity"):
+    _AVAILABLE_CPUS = len(os.sched_getaffinity(0))
+else:
+    _AVAILABLE_CPUS = os.cpu_count() or 2
+TREE_THREADS = max(1, _AVAILABLE_CPUS // 2)
+
+# Long-lived sidecar process for one script, started with --server so the
+# interpreter and Biopython/DendroPy imports are paid once rather than on every
+# analysis. Requests and responses are single JSON lines (see worker_server.py).
+class WorkerPool:
+    def __init__(self, script, timeout):
+        self.script = script
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.proc = None
+        # Where the current request's stderr goes, if its caller wants it
+        self.sink = None
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-u", self.script, "--server"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            # Its own process group, so a timeout also kills MAFFT/IQ-TREE
+            start_new_session=True,
+        )
+        threading.Thread(target=self.read_log, args=(self.proc.stderr,), daemon=True).start()
+
+    def read_log(self, stream):
+        # Drain stderr as it is written so the worker never blocks on a full
+        # pipe, still echoing it to the app's own stderr
+        for line in stream:
+            sink = self.sink
+            if sink is not None:
+                sink.append(line)
+            sys.stderr.write(line)
+
+    def expire(self, proc, timed_out):
+        timed_out.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def call(self, request, on_start=None, log=None):
+        # on_start is called once this request has the worker, after any wait
+        # behind other sessions' requests. log, a deque, receives the worker's
+        # stderr lines while this request (and no other) is running.
+        with self.lock:
+            if on_start is not None:
+                on_start()
+            if self.proc.poll() is not None:
+                self.start()
+            self.sink = log
+            timed_out = threading.Event()
+            timer = threading.Timer(self.timeout, self.expire, args=(self.proc, timed_out))
+            timer.start()
+            try:
+                self.proc.stdin.write(json.dumps(request) + "\n")
+                self.proc.stdin.flush()
+                line = self.proc.stdout.readline()
+            except BrokenPipeError:
+                line = ""
+            finally:
+                timer.cancel()
+                self.sink = None
+
+            if timed_out.is_set():
+                self.proc.wait()
+                self.start()
+                return {"error": f"{self.script} worker took longer than {self.timeout} s and was restarted"}
+
+        if not line:
+            return {"error": f"{self.script} worker exited unexpectedly (return code {self.proc.poll()})"}
+        return json.loads(line)
+
+@st.cache_resource
+def get_workers():
+    return {
+        "p_distance": WorkerPool("p-distance-calc.py", WORKER_TIMEOUTS["p_distance"]),
+        "ml_tree": WorkerPool("infer_new_ML_tree.py", WORKER_TIMEOUTS["ml_tree"]),
+        "subtype": WorkerPool("ML_patristic-dist_calc.py", WORKER_TIMEOUTS["subtype"]),
+    }
+
+# Start the workers as soon as the app loads so their imports and warmup
+# calls are done before the first upload
+get_workers()
 
 def log_error(message):
     st.error(message)
 
-def extract_fasta_header(input_fasta):
+def header_and_length(input_fasta):
+    # ID and sequence length of the first record, read in a single pass
+    query_id = None
+    seq_len = 0
     with open(input_fasta, 'r') as file:
-        for record in SeqIO.parse(file, "fasta"):
-            return record.id
-
-def calculate_p_distance(input_fasta, reference_fasta):
+        for line in file:
+            if line.startswith(">"):
+                if query_id is not None:
+                    break
+                query_id = (line[1:].split() or [""])[0]
+            elif query_id is not None:
+                # SeqIO drops any whitespace inside a sequence line, not just at its ends
+                seq_len += len("".join(line.split()))
+    return query_id, seq_len
+
+# Everything one analysis needs to know about its input and output paths,
+# built once per upload
+@dataclass(frozen=True)
+class RunContext:
+    query_id: str
+    temp_fasta: str
+    digest: str
+    cache_key: str
+    output_dir: str
+    alignment_path: str
+    tree_prefix: str
+    newick_path: str
+
+def reference_mtimes():
+    # Stage results also depend on the reference files, so a change to any of
+    # them must not be served from an entry made with the old ones
+    mtimes = []
+    for path in _REF_ABS.values():
+        try:
+            mtimes.append(str(os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            mtimes.append("missing")
+    return ":".join(mtimes)
+
+def make_run_context(query_id, temp_fasta, digest):
+    # Each run writes to its own directory under output/, since the workers
+    # are shared by every session and two uploads may have the same query ID
+    output_dir = tempfile.mkdtemp(dir=_abspath(OUTPUT_DIR))
+    tree_prefix = os.path.join(output_dir, f"{query_id}_reoptimised")
+    return RunContext(
+        query_id=query_id,
+        temp_fasta=_abspath(temp_fasta),
+        digest=digest,
+        cache_key=hashlib.blake2b(f"{digest}:{reference_mtimes()}".encode(), digest_size=16).hexdigest(),
+        output_dir=output_dir,
+        alignment_path=os.path.join(output_dir, f"{query_id}_updated.fasta"),
+        tree_prefix=tree_prefix,
+        newick_path=f"{tree_prefix}.treefile",
+    )
+
+def shm_output_dir():
+    # /dev/shm is world-writable, so the directory is only used when it is a
+    # real directory of our own rather than something planted under its name
     try:
-        command = [sys.executable, "p-distance-calc.py", input_fasta, reference_fasta]
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            log_error(f"Error calculating p-distance. Return code: {result.returncode}")
-            log_error(f"Standard Error:\n{result.stderr}")
-            return None
+        os.mkdir(SHM_OUTPUT_DIR, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(SHM_OUTPUT_DIR)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        return None
+    return SHM_OUTPUT_DIR
 
+def prepare_output_dir():
+    # tmpfs is emptied on reboot, so the link target may need recreating
+    shm_dir = shm_output_dir() if SHM_DIR is not None else None
+    if os.path.islink(OUTPUT_DIR):
+        if shm_dir is not None and os.readlink(OUTPUT_DIR) == shm_dir:
+            return
+        # Left by an older version, or its target can no longer be trusted
         try:
-            with open("output/p_distance_output.json", "r") as file:
-                result = json.load(file)
-            return result
+            os.remove(OUTPUT_DIR)
         except FileNotFoundError:
-            log_error("Error: p_distance_output.json not found in output directory.")
-            return None
-        except json.JSONDecodeError:
-            log_error("Error: Could not decode JSON from p_distance_output.json")
-            return None
-
-    except subprocess.CalledProcessError as e:
-        log_error(f"Subprocess error: {e}")
-        return None
-    
-def infer_new_tree(existing_alignment, new_sequence, query_id, existing_tree, output_dir):
-    output_alignment = os.path.join(output_dir, f"{query_id}_updated.fasta")
-    output_tree = os.path.join(output_dir, f"{query_id}_reoptimised")
-    script_path = "infer_new_ML_tree.py"
+            pass
 
-    command = [sys.executable, script_path, existing_alignment, new_sequence, existing_tree, output_alignment, output_tree]
+    if shm_dir is not None and not os.path.exists(OUTPUT_DIR):
+        try:
+            os.symlink(shm_dir, OUTPUT_DIR)
+        except FileExistsError:
+            # Another session created it first
+            pass
+    else:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+def read_cache_entry(entry_dir, output_dir):
+    # The stage's result with its files copied into output_dir, or None when
+    # there is no usable entry: never written, evicted while being read, or
+    # holding the NaN/Infinity that json.dump can write and orjson rejects
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            st.error(f"Error inferring new ML tree. Return code: {result.returncode}")
-            return None, None, None
-
-        # Check if the output file was created
-        ml_tree_output_path = os.path.join(output_dir, "ml_tree_output.json")
-        if not os.path.exists(ml_tree_output_path):
-            st.error(f"Error: {ml_tree_output_path} not found after execution.")
-            return None, None, None
-
-        with open(ml_tree_output_path, "r") as file:
-            result = json.load(file)
-        return result, output_alignment, output_tree
-
-    except FileNotFoundError:
-        st.error("Error: infer_new_ML_tree.py not found. Ensure the file exists and the path is correct.")
-        return None, None, None
-    except subprocess.CalledProcessError as e:
-        st.error(f"Subprocess error: {e}")
-        st.error(f"Return code: {e.returncode}")
-        st.error(f"Output: {e.output}")
-        st.error(f"Error: {e.stderr}")
-        return None, None, None
-
-def infer_subtype(input_newick, predefined_label, csv_file):
-    command = [sys.executable, "ML_patristic-dist_calc.py", input_newick, predefined_label, csv_file]
-
+        with open(os.path.join(entry_dir, "result.json"), "rb") as file:
+            cached = orjson.loads(file.read())
+        for name in cached["files"]:
+            shutil.copy2(os.path.join(entry_dir, name), os.path.join(output_dir, name))
+        # Marks the input as recently used for evict_cache()
+        os.utime(os.path.dirname(entry_dir))
+    except (FileNotFoundError, orjson.JSONDecodeError, json.JSONDecodeError):
+        # Cleared so the recomputed result can take its place
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+    return cached["result"]
+
+def write_cache_entry(entry_dir, result, files, output_dir):
+    # Filled in a private directory and renamed into place, so a run with the
+    # same input never sees a partial entry; if another run got there first,
+    # its entry is kept and this one dropped
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+    for name in files:
+        shutil.copy2(os.path.join(output_dir, name), staging_dir)
+    with open(os.path.join(staging_dir, "result.json"), "w") as file:
+        json.dump({"result": result, "files": files}, file)
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            log_error(f"Error inferring subtype. Return code: {result.returncode}")
-            log_error(f"Standard Error:\n{result.stderr}")
-            return None
+        os.rename(staging_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
+def evict_cache():
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
         try:
-            with open("output/subtype_output.json", "r") as file:
-                result = json.load(file)
+            entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            pass
+    for _, path in sorted(entries, reverse=True)[CACHE_MAX_ENTRIES:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def disk_cache(stage, artifacts):
+    # Reuse a stage's result when the same input has been analysed against the
+    # same reference files. The result and the files named by artifacts(result)
+    # in ctx.output_dir are kept under CACHE_DIR/<ctx.cache_key>/<stage>/ and
+    # copied back on a hit, which is added to hits when given. An entry that
+    # cannot be read back in full is recomputed. call_options are passed on to
+    # the stage's WorkerPool.call().
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(ctx, hits=None, **call_options):
+            entry_dir = os.path.join(CACHE_DIR, ctx.cache_key, stage)
+            cached = read_cache_entry(entry_dir, ctx.output_dir)
+            if cached is not None:
+                if hits is not None:
+                    hits.add(stage)
+                return cached
+
+            result = func(ctx, **call_options)
+            write_cache_entry(entry_dir, result, artifacts(result), ctx.output_dir)
             return result
+        return wrapper
+    return decorator
+
+@disk_cache("p_distance", lambda result: ["p_distance_output.json", "p_distances.txt"])
+def calculate_p_distance(ctx, **call_options):
+    pool = get_workers()["p_distance"]
+    response = pool.call({"input": ctx.temp_fasta, "reference": _REF_ABS[REFERENCE_FASTA], "output_dir": ctx.output_dir}, **call_options)
+
+    if "error" in response:
+        raise RuntimeError(f"Error calculating p-distance: {response['error']}")
+    return response["result"]
+    
+def tree_artifacts(result):
+    return result["produced_files"] + ["ml_tree_output.json"]
+
+@disk_cache("ml_tree", tree_artifacts)
+def infer_new_tree(ctx, **call_options):
+    pool = get_workers()["ml_tree"]
+    response = pool.call({
+        "alignment": _REF_ABS[EXISTING_ALIGNMENT],
+        "input": ctx.temp_fasta,
+        "tree": _REF_ABS[EXISTING_TREE],
+        "output_alignment": ctx.alignment_path,
+        "output_tree": ctx.tree_prefix,
+        "threads": TREE_THREADS,
+    }, **call_options)
+
+    if "error" in response:
+        raise RuntimeError(f"Error inferring new ML tree: {response['error']}")
+
+    # The updated alignment, its placement (_pp) files and the reoptimised tree
+    result = response["result"]
+    produced_files = glob.glob(ctx.alignment_path + "*") + glob.glob(ctx.tree_prefix + ".*")
+    result["produced_files"] = [os.path.basename(path) for path in produced_files]
+    return result
+
+@disk_cache("subtype", lambda result: ["subtype_output.json", "patristic_distances.txt"])
+def infer_subtype(ctx, **call_options):
+    pool = get_workers()["subtype"]
+    response = pool.call({"newick": ctx.newick_path, "label": ctx.query_id, "csv": _REF_ABS[CSV_FILE], "output_dir": ctx.output_dir}, **call_options)
+
+    if "error" in response:
+        raise RuntimeError(f"Error inferring subtype: {response['error']}")
+    return response["result"]
+
+def timed(func, ctx, hits, **call_options):
+    # Restarted once the stage's worker takes the request, so time queued
+    # behind other sessions' requests is not counted as the stage's runtime
+    stage_start = time.monotonic()
+
+    def on_start():
+        nonlocal stage_start
+        stage_start = time.monotonic()
+
+    result = func(ctx, hits, on_start=on_start, **call_options)
+    return result, time.monotonic() - stage_start
+
+def get_stage_times():
+    # Seconds each stage is expected to take, seeded with rough first-run
+    # estimates and refined by an exponential moving average of real runs
+    if "avg_stage_times" not in st.session_state:
+        st.session_state["avg_stage_times"] = dict(DEFAULT_STAGE_TIMES)
+    return st.session_state["avg_stage_times"]
+
+def record_stage_time(stage, elapsed):
+    avg_stage_times = get_stage_times()
+    avg_stage_times[stage] += STAGE_TIME_SMOOTHING * (elapsed - avg_stage_times[stage])
+
+def expected_stage_time(stage):
+    stage_times = get_stage_times()
+    if stage == "tree":
+        return max(stage_times["p_distance"], stage_times["ml_tree"])
+    return stage_times[stage]
+
+# State of one analysis running on a background thread. The thread only
+# updates this object; the page reads it from st.session_state["run"].
+class AnalysisRun:
+    def __init__(self, ctx, query_length):
+        self.ctx = ctx
+        self.query_length = query_length
+        self.stage = "tree"
+        self.stage_start = time.monotonic()
+        self.stage_times = {}
+        self.outputs = {}
+        self.error = None
+        # Stages served from the disk cache; their times say nothing about a
+        # real run and are kept out of the averages
+        self.cache_hits = set()
+        # IQ-TREE output of this run's tree request while it is running
+        self.tree_log = collections.deque(maxlen=200)
+        self.times_recorded = False
+        self.download_requested = False
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self.stage_start = time.monotonic()
+
+def run_analysis(run):
+    ctx = run.ctx
+    try:
+        # The p-distance only needs the query and reference FASTA, so it runs
+        # alongside the ML tree; subtype inference waits for the tree.
+        with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+            p_distance_future = executor.submit(timed, calculate_p_distance, ctx, run.cache_hits)
+            tree_future = executor.submit(timed, infer_new_tree, ctx, run.cache_hits, log=run.tree_log)
+            tree_future.add_done_callback(lambda future: run.tree_log.clear())
+
+            run.outputs["p_distance"], run.stage_times["p_distance"] = p_distance_future.result()
+            run.outputs["ml_tree"], run.stage_times["ml_tree"] = tree_future.result()
+
+        run.set_stage("subtype")
+        run.outputs["subtype"], run.stage_times["subtype"] = timed(infer_subtype, ctx, run.cache_hits)
+        evict_cache()
+    except Exception as e:
+        run.error = str(e)
+    finally:
+        # Everything worth keeping is in the cache entry by now
+        try:
+            os.remove(ctx.temp_fasta)
         except FileNotFoundError:
-            log_error("Error: subtype_output.json not found in output directory.")
-            return None
-        except json.JSONDecodeError:
-            log_error("Error: Could not decode JSON from subtype_output.json")
-            return None
-    except subprocess.CalledProcessError as e:
-        log_error(f"Subprocess error: {e}")
-        return None
+            pass
+        shutil.rmtree(ctx.output_dir, ignore_errors=True)
+        run.set_stage("done")
+
+@st.fragment(run_every="1s")
+def progress_fragment():
+    run = st.session_state["run"]
+    # Read once, as the analysis thread may move it on while this draws
+    stage, stage_start = run.stage, run.stage_start
+    if stage == "done":
+        # Hand over to a full rerun so main() renders the results
+        st.rerun()
+
+    # Move the bar in proportion to elapsed time against the expected runtime,
+    # holding short of the end until the stage has actually finished
+    label, start, end = STAGE_PROGRESS[stage]
+    elapsed = time.monotonic() - stage_start
+    fraction = min(elapsed / expected_stage_time(stage), 0.95)
+    st.progress(start + (end - start) * fraction)
+    st.write(f"\n{label} ({elapsed:.0f} s)")
+
+    # Tail of the IQ-TREE output, so a long or failing tree run is visible
+    # as it happens
+    if stage == "tree":
+        log_tail = list(run.tree_log)[-10:]
+        if log_tail:
+            st.code("".join(log_tail))
+
+@st.cache_data(max_entries=4)
+def build_archive(cache_key):
+    # Stream a tar of this run's files through zstd straight into memory,
+    # with no archive written to disk. The files come from the run's cache
+    # entries, laid out as output/ with the IQ-TREE files under iqtree/.
+    buf = io.BytesIO()
+    cctx = zstd.ZstdCompressor(level=3, threads=-1)
+    with cctx.stream_writer(buf, closefd=False) as writer, tarfile.open(fileobj=writer, mode="w|") as tf:
+        for stage in STAGES:
+            entry_dir = os.path.join(CACHE_DIR, cache_key, stage)
+            # json rather than orjson, which rejects the NaN a degenerate result may hold
+            with open(os.path.join(entry_dir, "result.json")) as file:
+                cached = json.load(file)
+            iqtree_files = set(cached["result"].get("produced_files", []))
+            for name in cached["files"]:
+                arcname = f"output/iqtree/{name}" if name in iqtree_files else f"output/{name}"
+                tf.add(os.path.join(entry_dir, name), arcname=arcname)
+    return buf.getvalue()
+
+def request_download():
+    st.session_state["run"].download_requested = True
+
+@st.fragment
+def download_fragment():
+    # The archive is only built once the user asks for it, and the fragment
+    # keeps that click from rerunning the whole results page
+    run = st.session_state["run"]
+    if run.download_requested:
+        try:
+            archive = build_archive(run.ctx.cache_key)
+        except FileNotFoundError:
+            log_error("The output of this analysis has since been dropped from the cache; upload the file again to rerun it.")
+            return
+        st.download_button("Download Output", archive, file_name="output.tar.zst")
+    else:
+        st.button("Prepare download", on_click=request_download)
+
+def clear_run():
+    st.session_state.pop("run", None)
 
 def main():
     st.title("Rat Hepatitis E Subtyping Tool v1.0")
     st.header("Sridhar Group")
-    
-    reference_fasta = "reference_genomes.fa"
-    existing_alignment = "reference_alignment.fa"
-    existing_tree = "reference_tree.tree"
-    csv_file = "reference_subtypes.csv"
 
     input_fasta = st.file_uploader("Upload FASTA file", type=["fasta", "fas", "fa"])
-
-    output_dir = "output"
     
     if input_fasta is not None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".fasta", mode="w+t") as tmp_file:
-            tmp_file.write(input_fasta.getvalue().decode())
-            temp_fasta_path = tmp_file.name
-
-        query_id = extract_fasta_header(temp_fasta_path)
+        with input_fasta.getbuffer() as buffer:
+            digest = hashlib.blake2b(buffer, digest_size=16).hexdigest()
+
+            # A new upload starts a background analysis; reruns for the same
+            # upload only redraw its progress or results
+            run = st.session_state.get("run")
+            if run is None or run.ctx.digest != digest:
+                with tempfile.NamedTemporaryFile(delete=False, suffix=".fasta", mode="wb", dir=SHM_DIR) as tmp_file:
+                    input_fasta.seek(0)
+                    shutil.copyfileobj(input_fasta, tmp_file, length=1 << 20)
+                    temp_fasta_path = tmp_file.name
+
+                query_id, query_length = header_and_length(temp_fasta_path)
+                prepare_output_dir()
+
+                run = AnalysisRun(make_run_context(query_id, temp_fasta_path, digest), query_length)
+                st.session_state["run"] = run
+                analysis_thread = threading.Thread(target=run_analysis, args=(run,), daemon=True)
+                add_script_run_ctx(analysis_thread).start()
 
         st.write("\n**Summary Statistics:**")
-        st.write(f"**Query ID:** {query_id}")
-        
-        with open(temp_fasta_path, 'r') as file:
-            for record in SeqIO.parse(file, "fasta"):
-                st.write(f"**Query Length:** {len(record.seq)}")
-                break
-        
-        os.makedirs(output_dir, exist_ok=True)
-        
-        progress_bar = st.progress(0)
-        status_placeholder = st.empty()
-
-        status_placeholder.write("\nCalculating p-distance...")
-        for i in range(40):
-            progress_bar.progress(i / 100)
-            time.sleep(0.8)
-        p_distance_output = calculate_p_distance(temp_fasta_path, reference_fasta)
-        if p_distance_output:
-            st.success("P-distance calculation completed.")
-        else:
-            st.error("Failed to calculate p-distance.")
-            return
-        
-        status_placeholder.write("\nInferring new ML tree...")
-        for i in range(59):
-            progress_value = 0.4 + (i / 59) * 0.59
-            progress_bar.progress(progress_value)
-            time.sleep(0.8)
-        tree_output, output_alignment, output_tree = infer_new_tree(existing_alignment, temp_fasta_path, query_id, existing_tree, output_dir)
-        if tree_output:
-            st.success("New ML tree inference completed.")
-        else:
-            st.error("Failed to infer new ML tree.")
+        st.write(f"**Query ID:** {run.ctx.query_id}")
+        st.write(f"**Query Length:** {run.query_length}")
+
+        if run.stage != "done":
+            progress_fragment()
             return
-        
-        status_placeholder.write("\nInferring subtype...")
-        input_newick = f"{output_tree}.treefile"
-        predefined_label = query_id
-        subtype_output = infer_subtype(input_newick, predefined_label, csv_file)
-        if subtype_output:
-            st.success("Subtype inference completed.")
-            progress_bar.progress(100)
-        else:
-            st.error("Failed to infer subtype.")
+
+        for stage in STAGES:
+            if stage in run.stage_times:
+                st.success(f"{STAGE_MESSAGES[stage]} ({run.stage_times[stage]:.1f} s).")
+        if run.error:
+            log_error(run.error)
+            # The temp FASTA is gone by now, so a retry starts a fresh run
+            st.button("Retry", on_click=clear_run)
             return
-        
-        time.sleep(1)
-        status_placeholder.write("\nAnalysis completed!")
 
-        try:
-            with open("output/p_distance_output.json", "r") as file:
-                p_distance_result = json.load(file)
-            with open("output/ml_tree_output.json", "r") as file:
-                tree_result = json.load(file)
-            with open("output/subtype_output.json", "r") as file:
-                subtype_result = json.load(file)
+        if not run.times_recorded:
+            for stage, elapsed in run.stage_times.items():
+                if stage not in run.cache_hits:
+                    record_stage_time(stage, elapsed)
+            run.times_recorded = True
+
+        st.progress(100)
+        st.write("\nAnalysis completed!")
+
+        p_distance_output = run.outputs["p_distance"]
+        subtype_output = run.outputs["subtype"]
 
+        try:
             st.write("\n**Results Summary**")
 
             col1, col2 = st.columns(2)
 
             with col1:
                 st.write("**P-Distance Results**")
-                st.write(f"* **Closest Reference:** {p_distance_result['closest_reference']} ({p_distance_result['p_distance']:.4f})")
-                st.write(f"* **Below Cutoff:** {p_distance_result['below_cutoff']}")
+                st.write(f"* **Closest Reference:** {p_distance_output['closest_reference']} ({p_distance_output['p_distance']:.4f})")
+                st.write(f"* **Below Cutoff:** {p_distance_output['below_cutoff']}")
 
             with col2:
                 st.write("**ML Patristic Distance Results**")
-                st.write(f"* **Closest Reference:** {subtype_result['closest_reference_ml']} ({subtype_result['ml_distance']:.4f})")
-                st.write(f"* **Conflicts:** {subtype_result['conflicts']}")
+                st.write(f"* **Closest Reference:** {subtype_output['closest_reference_ml']} ({subtype_output['ml_distance']:.4f})")
+                st.write(f"* **Conflicts:** {subtype_output['conflicts']}")
 
-            if subtype_result['conflicts']:
+            if subtype_output['conflicts']:
                 with st.expander("Conflict Summary"):
-                    if subtype_result['subtype_assignment'] == "Not determined":
+                    if subtype_output['subtype_assignment'] == "Not determined":
                         st.write("* **Consensus Assignment:** Not determined due to conflicts.")
                     else:
                         try:
                             conflicting_taxa_info = []
-                            for taxon in subtype_result['conflict_summary']['conflicting_taxa']:
+                            for taxon in subtype_output['conflict_summary']['conflicting_taxa']:
                                 conflicting_taxa_info.append(f"{taxon['taxon']} (Clade {taxon['clade']} Subtype {taxon['subtype']})")
                             st.write(f"* **Conflicting Taxa:** {', '.join(conflicting_taxa_info)}")
-                            st.write(f"* **Conflicting Clades:** {', '.join(subtype_result['conflict_summary']['clades'])}")
-                            st.write(f"* **Conflicting Subtypes:** {', '.join(subtype_result['conflict_summary']['subtypes'])}")
+                            st.write(f"* **Conflicting Clades:** {', '.join(subtype_output['conflict_summary']['clades'])}")
+                            st.write(f"* **Conflicting Subtypes:** {', '.join(subtype_output['conflict_summary']['subtypes'])}")
                         except IndexError as e:
                             log_error(f"Error parsing subtype assignment: {e}")
             
-            st.write(f"\n**Subtype Assignment:** {subtype_result['subtype_assignment']}")
+            st.write(f"\n**Subtype Assignment:** {subtype_output['subtype_assignment']}")
 
-        except FileNotFoundError as e:
-            log_error(f"Error loading results: File not found - {e}")
-        except json.JSONDecodeError as e:
-            log_error(f"Error loading results: JSON decode error - {e}")
         except KeyError as e:
             log_error(f"Error loading results: Key error - {e}")
         except Exception as e:
             log_error(f"An unexpected error occurred: {e}")
 
-        try:
-            os.remove(temp_fasta_path)
-        except FileNotFoundError:
-            pass
-
-        iqtree_dir = os.path.join(output_dir, "iqtree")
-        os.makedirs(iqtree_dir, exist_ok=True)
-        
-        for filename in os.listdir(output_dir):
-            if "reoptimised" in filename or "updated" in filename:
-                file_path = os.path.join(output_dir, filename)
-                destination_path = os.path.join(iqtree_dir, filename)
-                os.rename(file_path, destination_path)
-        
-        with zipfile.ZipFile('output.zip', 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for root, dirs, files in os.walk('output'):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(file_path, start=os.path.dirname('output'))
-                    zip_file.write(file_path, relative_path)
-
-        with open("output.zip", "rb") as file:
-            zip_data = file.read()
-
-        st.download_button("Download Output", zip_data, file_name="output.zip")
+        download_fragment()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
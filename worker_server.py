@@ -0,0 +1,41 @@
+import sys
+import json
+import traceback
+
+# Request loop shared by the sidecar scripts when started with --server.
+#
+# Contract: one line in, one line out, no buffering. Each request is a single
+# JSON object on one line of stdin; each response is a single JSON object on
+# one line of stdout, flushed as soon as it is written. A response is either
+# {"result": ...} or {"error": "..."}. The worker must never write anything
+# else to stdout, so stdout is redirected to stderr while a request is handled.
+#
+# warmup, if given, runs once before the first request so that lazy imports
+# and first-call setup are paid at startup rather than on the first analysis.
+
+def serve(handler, warmup=None):
+    responses = sys.stdout
+    sys.stdout = sys.stderr
+
+    if warmup is not None:
+        try:
+            warmup()
+        except Exception:
+            traceback.print_exc()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        try:
+            result = handler(json.loads(line))
+            if isinstance(result, dict) and "error" in result:
+                response = {"error": result["error"]}
+            else:
+                response = {"result": result}
+        except Exception as e:
+            traceback.print_exc()
+            response = {"error": f"{type(e).__name__}: {e}"}
+
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()